@@ -1,31 +1,109 @@
 import datetime
+import functools
+import json
+import itertools
+import random
 import time
 import logging
 from abc import ABC, abstractmethod
 from typing import Dict, Tuple, Optional, Callable, List, Iterable
-from requests import ReadTimeout
 
 from web3 import AsyncWeb3
 from web3.contract import AsyncContract
-from web3.datastructures import AttributeDict
-from web3.exceptions import BlockNotFound
 from eth_abi.codec import ABICodec
+from eth_abi.grammar import parse as parse_abi_type
+from cachetools import LRUCache
+from pymongo.errors import BulkWriteError
+import orjson
 
-# Currently this method is not exposed over official web3 API,
-# but we need it to construct eth_get_logs parameters
-from web3._utils.filters import construct_event_filter_params
-from web3._utils.events import get_event_data
+from eth_utils import encode_hex, keccak, to_bytes, to_checksum_address
 
-import asyncio
+# Currently these methods are not exposed over official web3 API
+from web3._utils.abi import abi_to_signature
+from web3._utils.request import async_make_post_request
 
-import numpy as n
+import asyncio
 
-from hexbytes import HexBytes
+from provider import AsyncHTTPXProvider, decode_batch_response, encode_batch_request
 
 logger = logging.getLogger(__name__)
 
 MAX_CHUNK_SIZE = 1000
 
+# How many chunks we scan at the same time
+MAX_CONCURRENT_CHUNKS = 16
+
+# How many calls we pack into one JSON-RPC batch request.
+# Some providers (e.g. Optimism) reject batches larger than 10 calls
+MAX_BATCH_SIZE = 10
+
+# How many block timestamp batches one scan has in flight at the same time
+MAX_CONCURRENT_BATCHES = 4
+
+# Substrings of errors providers return when `eth_get_logs` asks for too much.
+# Kept specific, so rate limits are not mistaken for them and retried without backing off
+PROVIDER_LIMIT_ERRORS = (
+    # Infura
+    "query returned more than",
+    # Alchemy
+    "log response size exceeded",
+    # QuickNode, "eth_getLogs is limited to a 10,000 range"
+    "eth_getlogs is limited to a",
+    # BSC and other Geth forks
+    "exceed maximum block range",
+    # Ankr
+    "block range is too large",
+)
+
+# How many events we buffer before writing them to MongoDB
+INSERT_BATCH_SIZE = 1000
+
+# MongoDB error code of a unique index violation
+DUPLICATE_KEY_ERROR = 11000
+
+# Reduced ERC-20 ABI, only Transfer event.
+# Parsed once on import, not on every scan
+ERC20_TRANSFER_ABI = json.loads("""[
+    {
+        "anonymous": false,
+        "inputs": [
+            {
+                "indexed": true,
+                "name": "from",
+                "type": "address"
+            },
+            {
+                "indexed": true,
+                "name": "to",
+                "type": "address"
+            },
+            {
+                "indexed": false,
+                "name": "value",
+                "type": "uint256"
+            }
+        ],
+        "name": "Transfer",
+        "type": "event"
+    }
+]
+""")
+
+# Keccak of the ERC-20 Transfer event signature, the first topic of its logs
+TRANSFER_TOPIC = "0xddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef"
+
+# Hex encoded keccak of event signatures, the first topic of their logs.
+# Filled lazily, ERC-20 Transfer is known up front
+_TOPIC0_CACHE: Dict[str, str] = {
+    "Transfer(address,address,uint256)": TRANSFER_TOPIC,
+}
+
+# The same holders show up in transfer after transfer, remember their checksummed addresses
+_checksum_address = functools.lru_cache(maxsize=100_000)(to_checksum_address)
+
+# Block timestamps never change, so we remember them as long as the process lives
+_BLOCK_TIMESTAMPS = LRUCache(maxsize=50_000)
+
 class EventScannerState(ABC):
     """Application state that remembers what blocks we have scanned in the case of crash.
     """
@@ -38,25 +116,93 @@ class EventScannerState(ABC):
         """
 
     @abstractmethod
-    def end_chunk(self, block_number: int):
+    async def end_chunk(self, block_number: int):
         """Scanner finished a number of blocks.
 
         Persistent any data in your state now.
         """
 
     @abstractmethod
-    def process_event(self, block_when: datetime.datetime, event: AttributeDict) -> object:
+    def process_event(self, block_when: int, event: dict) -> object:
         """Process incoming events.
 
         This function takes raw events from Web3, transforms them to your application internal
         format, then saves them in a database or some other state.
 
-        :param block_when: When this block was mined
+        :param block_when: When this block was mined, as UNIX timestamp
+
+        :param event: Plain dictionary of the event data
 
-        :param event: Symbolic dictionary of the event data
+        :return: Flat document that is the result of event tranformation.
+        """
+
+
+class BlockTimestampCache:
+    """Remember block timestamps across chunks and scanner restarts.
 
-        :return: Internal state structure that is the result of event tranformation.
+    Timestamps are looked up from memory, then from MongoDB and only then from JSON-RPC.
+    Anything fetched over JSON-RPC is written back, so rescans do not hit the node again.
+    """
+
+    def __init__(self, mongo, web3: AsyncWeb3, memory: LRUCache = None,
+                 max_request_retries: int = 4, request_retry_seconds: float = 12.0):
+        """
+        :param mongo: Database holding the `blockTimestamps` collection
+        :param memory: In-memory cache, shared by all scanners of the process by default
+        :param max_request_retries: How many times we try to reattempt a failed JSON-RPC batch
+        :param request_retry_seconds: Base delay between failed batches, grows exponentially with jitter
         """
+        self.mongo = mongo
+        self.web3 = web3
+        self.memory = _BLOCK_TIMESTAMPS if memory is None else memory
+        self.max_request_retries = max_request_retries
+        self.request_retry_seconds = request_retry_seconds
+        # Shared by all chunks scanned concurrently, so they do not flood the node together
+        self._batch_slots = asyncio.Semaphore(MAX_CONCURRENT_BATCHES)
+
+    async def get(self, block_num: int) -> Optional[int]:
+        """Get timestamp of a single block."""
+        timestamps = await self.get_many([block_num])
+        return timestamps.get(block_num)
+
+    async def get_many(self, block_numbers: Iterable[int]) -> Dict[int, int]:
+        """Get timestamps of many blocks.
+
+        :return: block number -> block timestamp, blocks not mined yet are left out
+        """
+        timestamps = {}
+        missing = []
+        for block_num in set(block_numbers):
+            if block_num in self.memory:
+                timestamps[block_num] = self.memory[block_num]
+            else:
+                missing.append(block_num)
+
+        if missing:
+            async for doc in self.mongo.blockTimestamps.find({"_id": {"$in": missing}}):
+                timestamps[doc["_id"]] = self.memory[doc["_id"]] = doc["timestamp"]
+            missing = [block_num for block_num in missing if block_num not in timestamps]
+
+        if missing:
+            fetched = await _fetch_block_timestamps(self.web3, missing,
+                                                    semaphore=self._batch_slots,
+                                                    retries=self.max_request_retries,
+                                                    delay=self.request_retry_seconds)
+            # Do not remember blocks that are not mined yet
+            fetched = {block_num: ts for block_num, ts in fetched.items() if ts is not None}
+            if fetched:
+                try:
+                    await self.mongo.blockTimestamps.insert_many(
+                        [{"_id": block_num, "timestamp": ts} for block_num, ts in fetched.items()],
+                        ordered=False)
+                except BulkWriteError as e:
+                    # Another scan stored some of these blocks first, anything else is a real error
+                    if any(error["code"] != DUPLICATE_KEY_ERROR for error in e.details["writeErrors"]):
+                        raise
+            self.memory.update(fetched)
+            timestamps.update(fetched)
+
+        return timestamps
 
 
 class EventScanner:
@@ -71,7 +217,8 @@ class EventScanner:
     """
 
     def __init__(self, mongo, web3: AsyncWeb3, contract: AsyncContract, state: EventScannerState, events: List, filters: Dict,
-                 max_chunk_scan_size: int = 10000, max_request_retries: int = 4, request_retry_seconds: float = 12.0):
+                 max_chunk_scan_size: int = 10000, max_request_retries: int = 4, request_retry_seconds: float = 12.0,
+                 ts_cache: BlockTimestampCache = None):
         """
         :param contract: Contract
         :param events: List of web3 Event we scan
@@ -79,44 +226,69 @@ class EventScanner:
         :param max_chunk_scan_size: JSON-RPC API limit in the number of blocks we query. (Recommendation: 10,000 for mainnet, 500,000 for testnets)
         :param max_request_retries: How many times we try to reattempt a failed JSON-RPC call
         :param request_retry_seconds: Delay between failed requests to let JSON-RPC server to recover
+        :param ts_cache: Block timestamp cache, backed by `mongo` if not given
         """
 
         self.logger = logger
         self.contract = contract
         self.web3 = web3
         self.mongo = mongo
+        self.ts_cache = ts_cache or BlockTimestampCache(mongo, web3,
+                                                        max_request_retries=max_request_retries,
+                                                        request_retry_seconds=request_retry_seconds)
 
         self.state = state
         self.events = events
         self.filters = filters
 
+        # Depending on the Solidity version used to compile
+        # the contract that uses the ABI,
+        # it might have Solidity ABI encoding v1 or v2.
+        # We just assume the default that you set on Web3 object here.
+        # More information here https://eth-abi.readthedocs.io/en/latest/index.html
+        self.codec: ABICodec = web3.codec
+
+        # Only the event types we were asked for are scanned
+        self._filtered_events = [event_type for event_type in events if event_type.event_name == filters.get("event_type")]
+
+        # Event decoders keyed by their signature (topic0), the same for every chunk,
+        # so we build them only once
+        self._decoders = {}
+        for event_type in self._filtered_events:
+            # Currently no way to poke this using a public Web3.py API.
+            # This will return raw underlying ABI JSON object for the event
+            abi = event_type._get_event_abi()
+            self._decoders[_event_topic0(abi)] = _make_log_decoder(self.codec, abi)
+
+        # Ask for all event types in one `eth_get_logs` call,
+        # the node filters the logs by their signature on its side
+        self._event_filter_params = {"topics": [list(self._decoders)]}
+        if filters.get("address"):
+            self._event_filter_params["address"] = filters["address"]
+
         # Our JSON-RPC throttling parameters
         self.min_scan_chunk_size = 10  # 12 s/block = 120 seconds period
         self.max_scan_chunk_size = max_chunk_scan_size
         self.max_request_retries = max_request_retries
         self.request_retry_seconds = request_retry_seconds
 
-        # Factor how fast we increase the chunk size if results are found
-        # # (slow down scan after starting to get hits)
-        self.chunk_size_decrease = 0.5
+        # How many blocks the provider is known to serve in one `eth_get_logs`,
+        # lowered for the rest of the run whenever the provider reports its limit
+        self._chunk_cap = self.max_scan_chunk_size
+        self._successes_at_cap = 0
 
-        # Factor how was we increase chunk size if no results found
-        self.chunk_size_increase = 2.0
+        # Factor how fast we raise the cap back up
+        # after `chunk_cap_grow_after` successful calls in a row
+        self.chunk_cap_increase = 1.25
+        self.chunk_cap_grow_after = 10
 
     @property
     def address(self):
         return self.token_address
 
-    async def get_block_timestamp(self, block_num) -> datetime.datetime:
-        """Get Ethereum block timestamp"""
-        try:
-            block_info = await self.web3.eth.get_block(block_num)
-        except BlockNotFound:
-            # Block was not mined yet,
-            # minor chain reorganisation?
-            return None
-        last_time = block_info["timestamp"]
-        return datetime.datetime.utcfromtimestamp(last_time)
+    async def get_block_timestamp(self, block_num) -> int:
+        """Get Ethereum block timestamp as UNIX timestamp"""
+        return await self.ts_cache.get(block_num)
 
     def get_suggested_scan_start_block(self):
         """Get where we should start to scan for new token events.
@@ -144,153 +316,130 @@ class EventScanner:
     def get_last_scanned_block(self) -> int:
         return self.state.get_last_scanned_block()
 
-    async def scan_chunk(self, start_block, end_block) -> Tuple[int, datetime.datetime, list]:
+    async def scan_chunk(self, start_block, end_block) -> Tuple[int, list]:
         """Read and process events between to block numbers.
 
         Dynamically decrease the size of the chunk if the case JSON-RPC server pukes out.
 
-        :return: tuple(actual end block number, when this block was mined, processed events)
+        :return: tuple(actual end block number, processed events)
         """
 
-        block_timestamps = {}
-        get_block_timestamp = self.get_block_timestamp
-
-        # Cache block timestamps to reduce some RPC overhead
-        # Real solution might include smarter models around block
-        async def get_block_when(block_num):
-            if block_num not in block_timestamps:
-                block_timestamps[block_num] = await get_block_timestamp(block_num)
-            return block_timestamps[block_num]
-
         all_processed = []
 
-        target_event_type = self.filters["event_type"]
-        filtered_events = [event_type for event_type in self.events if event_type.event_name==target_event_type]
-        for event_type in filtered_events:
+        # Callable that takes care of the underlying web3 call
+        async def _fetch_events(_start_block, _end_block):
+            return await _fetch_events_for_all_contracts(self.web3,
+                                                         self._decoders,
+                                                         self._event_filter_params,
+                                                         from_block=_start_block,
+                                                         to_block=_end_block)
 
-            # Callable that takes care of the underlying web3 call
-            async def _fetch_events(_start_block, _end_block):
-                return await _fetch_events_for_all_contracts(self.web3,
-                                                       event_type,
-                                                       self.filters,
-                                                       from_block=_start_block,
-                                                       to_block=_end_block)
+        # Block ranges still to scan
+        pending = [(start_block, end_block)]
+        while pending:
+            chunk_start, chunk_end = pending.pop()
 
             # Do `n` retries on `eth_get_logs`,
             # throttle down block range if needed
-            end_block, events = await _retry_web3_call(
+            fetched_to_block, events = await _retry_web3_call(
                 _fetch_events,
-                start_block=start_block,
-                end_block=end_block,
+                start_block=chunk_start,
+                end_block=min(chunk_end, chunk_start + self._chunk_cap - 1),
                 retries=self.max_request_retries,
-                delay=self.request_retry_seconds)
+                delay=self.request_retry_seconds,
+                on_limit=self._shrink_chunk_cap)
+            self._grow_chunk_cap()
 
-            for evt in events:
-                # Integer of the log index position in the block, null when its pending
-                idx = evt["logIndex"]
+            if fetched_to_block < chunk_end:
+                # The block range was capped or throttled down, scan the rest of it separately
+                pending.append((fetched_to_block + 1, chunk_end))
 
-                # We cannot avoid minor chain reorganisations, but
-                # at least we must avoid blocks that are not mined yet
-                assert idx is not None, "Somehow tried to scan a pending block"
+            # Log index is null for pending blocks. We cannot avoid minor chain reorganisations,
+            # but at least we must avoid blocks that are not mined yet.
+            # Logs are ordered, so only the last one can be pending
+            if events and events[-1]["logIndex"] is None:
+                raise RuntimeError("Somehow tried to scan a pending block")
 
+            # Fetch timestamps of all blocks with events at once,
+            # known blocks are served from the cache without RPC overhead
+            block_timestamps = await self.ts_cache.get_many(evt["blockNumber"] for evt in events)
+
+            for evt in events:
                 block_number = evt["blockNumber"]
 
                 # Get UTC time when this event happened (block mined timestamp)
                 # from our in-memory cache
-                block_when = await get_block_when(block_number)
+                block_when = block_timestamps.get(block_number)
                 logger.info(f"Processing event {evt['event']}, block:{evt['blockNumber']} TX-index :{evt['transactionIndex']} Log-index :{evt['logIndex']}")
                 processed = self.state.process_event(block_when, evt)
                 all_processed.append(processed)
 
-        end_block_timestamp = await get_block_when(end_block)
-        return end_block, end_block_timestamp, all_processed
-
-    def estimate_next_chunk_size(self, current_chuck_size: int, event_found_count: int):
-        """Try to figure out optimal chunk size
-
-        Our scanner might need to scan the whole blockchain for all events
-
-        * We want to minimize API calls over empty blocks
+        return end_block, all_processed
 
-        * We want to make sure that one scan chunk does not try to process too many entries once, as we try to control commit buffer size and potentially asynchronous busy loop
+    def _shrink_chunk_cap(self, failed_size: int) -> int:
+        """Provider refused `failed_size` blocks at once, ask for less for the rest of the run.
 
-        * Do not overload node serving JSON-RPC API by asking data for too many events at a time
-
-        Currently Ethereum JSON-API does not have an API to tell when a first event occurred in a blockchain
-        and our heuristics try to accelerate block fetching (chunk size) until we see the first event.
-
-        These heurestics exponentially increase the scan chunk size depending on if we are seeing events or not.
-        When any transfers are encountered, we are back to scanning only a few blocks at a time.
-        It does not make sense to do a full chain scan starting from block 1, doing one JSON-RPC call per 20 blocks.
+        :return: New block range cap
+        """
+        # Concurrent chunks may have lowered the cap already
+        if failed_size <= self._chunk_cap:
+            self._chunk_cap = max(self.min_scan_chunk_size, failed_size // 2)
+            logger.warning(f"Provider block range limit hit, capping chunks to {self._chunk_cap} blocks")
+        self._successes_at_cap = 0
+        return self._chunk_cap
+
+    def _grow_chunk_cap(self):
+        """Slowly raise the block range cap back while the provider keeps up."""
+        self._successes_at_cap += 1
+        if self._successes_at_cap >= self.chunk_cap_grow_after:
+            self._chunk_cap = min(self.max_scan_chunk_size, int(self._chunk_cap * self.chunk_cap_increase))
+            self._successes_at_cap = 0
+
+    async def scan(self, start_block, end_block) -> list:
+        """Read and process events between two block numbers.
+
+        The block range is sliced into fixed windows of `max_scan_chunk_size` blocks
+        that are scanned concurrently, at most `MAX_CONCURRENT_CHUNKS` at a time.
+
+        :return: All processed events
         """
 
-        if event_found_count > 0:
-            # When we encounter first events, reset the chunk size window
-            current_chuck_size = self.min_scan_chunk_size
-        else:
-            current_chuck_size *= self.chunk_size_increase
+        assert start_block <= end_block
 
-        current_chuck_size = max(self.min_scan_chunk_size, current_chuck_size)
-        current_chuck_size = min(self.max_scan_chunk_size, current_chuck_size)
-        return int(current_chuck_size)
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_CHUNKS)
 
-    async def scan(self, start_block, end_block, start_chunk_size=20) -> Tuple[
-            list, int]:
+        async def scan_window(window_start, window_end):
+            async with semaphore:
+                logger.info(f"Scanning token transfers for blocks: {window_start} - {window_end}")
+                start = time.time()
+                _, new_entries = await self.scan_chunk(window_start, window_end)
+                logger.info(f"Blocks {window_start} - {window_end} took {time.time() - start} seconds, logs found {len(new_entries)}")
+                return new_entries
 
-        assert start_block <= end_block
+        chunk_size = self.max_scan_chunk_size
+        windows = [(window_start, min(window_start + chunk_size - 1, end_block))
+                   for window_start in range(start_block, end_block + 1, chunk_size)]
+        results = await asyncio.gather(*[scan_window(window_start, window_end) for window_start, window_end in windows])
 
         # All processed entries we got on this scan cycle
-        self.all_processed = []
-
-
-        async def taskCreator(self, start_b, end_b, start_chunk):
-            async def asincScan(start_b, end_b, chunk_size):
-                # pass
-                current_block = start_b
-                last_scan_duration = last_logs_found = 0
-                while current_block <= end_b:
-                    # Print some diagnostics to logs to try to fiddle with real world JSON-RPC API performance
-                    estimated_end_block = current_block + chunk_size
-                    logger.info(f"Scanning token transfers for blocks: {current_block} - {estimated_end_block}, chunk size {chunk_size}, last chunk scan took {last_scan_duration}, last logs found {last_logs_found}")
-
-                    start = time.time()
-                    actual_end_block, end_block_timestamp, new_entries = await self.scan_chunk(current_block, estimated_end_block)
-                    last_logs_found = len(new_entries)
-                    # Where does our current chunk scan ends - are we out of chain yet?
-                    current_end = actual_end_block
-
-                    last_scan_duration = time.time() - start
-
-                    self.all_processed += new_entries
-
-                    # Try to guess how many blocks to fetch over `eth_get_logs` API next time
-                    chunk_size = self.estimate_next_chunk_size(
-                        chunk_size, len(new_entries))
-                    chunk_size = chunk_size if chunk_size<=MAX_CHUNK_SIZE else MAX_CHUNK_SIZE
-
-                    # Set where the next chunk starts
-                    current_block = current_end + 1
-                    # total_chunks_scanned += 1
-                    self.state.end_chunk(current_end)
-                
-            tasks = []
-            cursor_b = start_b
-            while cursor_b + MAX_CHUNK_SIZE < end_b:
-                    start = cursor_b
-                    stop =  cursor_b + MAX_CHUNK_SIZE - 1
-                    cursor_b = cursor_b + MAX_CHUNK_SIZE
-                    tasks.append(asyncio.create_task(asincScan(start, stop, start_chunk)))
-            tasks.append(asyncio.create_task(asincScan(cursor_b, end_block, start_chunk)))
-
-            await asyncio.gather(*tasks)
-            print("all tasks done")
-            
-         
-        zzz = await taskCreator(self, start_block, end_block, start_chunk_size)
+        self.all_processed = list(itertools.chain.from_iterable(results))
+
+        # Windows finish in any order, so the progress is saved only once all of them are done
+        await self.state.end_chunk(end_block)
         return self.all_processed
 
 
-async def _retry_web3_call(func, start_block, end_block, retries, delay) -> Tuple[int, list]:
+def _is_provider_limit_error(e: Exception) -> bool:
+    """Did the provider refuse the call because of its block range or result size limits?"""
+    message = str(e).lower()
+    return any(limit_error in message for limit_error in PROVIDER_LIMIT_ERRORS)
+
+def _retry_delay(delay: float, attempt: int) -> float:
+    """Back off exponentially, with jitter so concurrent chunks do not retry in lockstep."""
+    return delay * 2 ** attempt * (1 + random.random() * 0.5)
+
+async def _retry_web3_call(func, start_block, end_block, retries, delay,
+                           on_limit: Optional[Callable[[int], int]] = None) -> Tuple[int, list]:
     """A custom retry loop to throttle down block range.
 
     If our JSON-RPC server cannot serve all incoming `eth_get_logs` in a single request,
@@ -303,31 +452,179 @@ async def _retry_web3_call(func, start_block, end_block, retries, delay) -> Tupl
     :param start_block: The initial start block of the block range
     :param end_block: The initial start block of the block range
     :param retries: How many times we retry
-    :param delay: Time to sleep between retries
+    :param delay: Base time to sleep between retries, grows exponentially with jitter
+    :param on_limit: Called with the refused block range size when the provider reports its limits,
+        returns how many blocks to ask for instead
+    :return: tuple(actually fetched end block, events)
     """
     for i in range(retries):
         try:
-            return end_block, await func(start_block, end_block)
+            events = await func(start_block, end_block)
+            return end_block, events
         except Exception as e:
             # Assume this is HTTPConnectionPool(host='localhost', port=8545): Read timed out. (read timeout=10)
             # from Go Ethereum. This translates to the error "context was cancelled" on the server side:
             # https://github.com/ethereum/go-ethereum/issues/20426
             if i < retries - 1:
+                failed_end_block = end_block
+                if on_limit is not None and _is_provider_limit_error(e):
+                    # The provider is fine, it just wants a smaller range
+                    sleep_time = 0
+                    chunk_cap = on_limit(end_block - start_block + 1)
+                    end_block = min(start_block + chunk_cap - 1, start_block + ((end_block - start_block) // 2))
+                else:
+                    sleep_time = _retry_delay(delay, i)
+                    # Decrease the `eth_getBlocks` range
+                    end_block = start_block + ((end_block - start_block) // 2)
                 # Give some more verbose info than the default middleware
-                logger.warning(f"Retrying events for block range {start_block} - {end_block} ({end_block-start_block}) failed with {e}, retrying in {delay} seconds")
-                # Decrease the `eth_getBlocks` range
-                end_block = start_block + ((end_block - start_block) // 2)
+                logger.warning(f"Retrying events for block range {start_block} - {failed_end_block} ({failed_end_block-start_block}) failed with {e}, retrying in {sleep_time} seconds")
                 # Let the JSON-RPC to recover e.g. from restart
-                time.sleep(delay)
+                await asyncio.sleep(sleep_time)
                 continue
             else:
                 logger.warning("Out of retries")
                 raise
 
+async def _make_raw_request(web3, payload):
+    """Post a raw JSON-RPC payload over the session of the provider.
+
+    Skips Web3.py result formatters and parses the response with orjson,
+    which is much faster than building `AttributeDict` and `HexBytes` objects.
+    """
+    provider = web3.provider
+    data = orjson.dumps(payload)
+    if isinstance(provider, AsyncHTTPXProvider):
+        raw_response = await provider.make_raw_request(data)
+    else:
+        raw_response = await async_make_post_request(
+            provider.endpoint_uri,
+            data,
+            **provider.get_request_kwargs())
+    return orjson.loads(raw_response)
+
+async def _make_batch_request(web3, requests: List[Tuple[str, list]]) -> list:
+    """Send (method, params) calls as one JSON-RPC batch over the session of the provider.
+
+    :return: Raw results in the order of `requests`
+    """
+    provider = web3.provider
+    if isinstance(provider, AsyncHTTPXProvider):
+        return await provider.make_batch_request(requests)
+    raw_response = await async_make_post_request(
+        provider.endpoint_uri,
+        encode_batch_request(requests),
+        **provider.get_request_kwargs())
+    return decode_batch_response(raw_response, len(requests))
+
+async def _fetch_block_timestamps(web3, block_numbers: Iterable[int], semaphore: asyncio.Semaphore,
+                                  retries: int, delay: float, batch_size: int = MAX_BATCH_SIZE) -> Dict[int, int]:
+    """Get timestamps of many blocks using JSON-RPC batch requests.
+
+    Web3.py 6 does not expose batch requests over its public API,
+    so we post the raw JSON-RPC array over the session of the provider.
+    Calls are split to batches of `batch_size` to respect provider limits.
+
+    :param semaphore: Limits how many batches are in flight at once
+    :param retries: How many times we try a failed batch
+    :param delay: Base time to sleep between retries, grows exponentially with jitter
+    :return: block number -> UNIX timestamp, None if the block was not mined yet
+    """
+    block_numbers = sorted(block_numbers)
+
+    async def _fetch_batch(batch):
+        requests = [("eth_getBlockByNumber", [hex(block_num), False]) for block_num in batch]
+        # Slot is kept while backing off, so a throttling node gets fewer requests
+        async with semaphore:
+            for i in range(retries):
+                try:
+                    # Any failed call fails the batch, so an error is never mistaken for a block not mined yet
+                    return await _make_batch_request(web3, requests)
+                except Exception as e:
+                    if i == retries - 1:
+                        logger.warning("Out of retries")
+                        raise
+                    sleep_time = _retry_delay(delay, i)
+                    logger.warning(f"Timestamps of blocks {batch[0]} - {batch[-1]} failed with {e}, retrying in {sleep_time} seconds")
+                    await asyncio.sleep(sleep_time)
+
+    batches = [block_numbers[i:i + batch_size] for i in range(0, len(block_numbers), batch_size)]
+    results = await asyncio.gather(*[_fetch_batch(batch) for batch in batches])
+
+    timestamps = {}
+    for batch, batch_results in zip(batches, results):
+        for block_num, block_info in zip(batch, batch_results):
+            # Block was not mined yet,
+            # minor chain reorganisation?
+            timestamps[block_num] = None if block_info is None else int(block_info["timestamp"], 16)
+    return timestamps
+
+def _event_topic0(abi: dict) -> str:
+    """Get the hex encoded signature hash of the event, cached for the process lifetime."""
+    signature = abi_to_signature(abi)
+    if signature not in _TOPIC0_CACHE:
+        _TOPIC0_CACHE[signature] = encode_hex(keccak(text=signature))
+    return _TOPIC0_CACHE[signature]
+
+def _topic_type(arg_type: str) -> str:
+    """Type to decode an indexed argument from its topic as.
+
+    Strings, bytes, arrays and tuples do not fit a topic, it holds only their keccak hash.
+    """
+    if arg_type.startswith("tuple"):
+        return "bytes32"
+    abi_type = parse_abi_type(arg_type)
+    if abi_type.is_dynamic or abi_type.is_array:
+        return "bytes32"
+    return arg_type
+
+def _make_log_decoder(codec: ABICodec, abi: dict) -> Callable[[dict], dict]:
+    """Build a function that decodes raw JSON-RPC logs of the event to plain dicts.
+
+    Argument names and types are resolved once here instead of walking the ABI for every log.
+    ERC-20 `Transfer` gets a fast path that reads the arguments straight from the hex strings.
+    """
+    event_name = abi["name"]
+    indexed_inputs = [(arg["name"], _topic_type(arg["type"])) for arg in abi["inputs"] if arg["indexed"]]
+    data_names = [arg["name"] for arg in abi["inputs"] if not arg["indexed"]]
+    data_types = [arg["type"] for arg in abi["inputs"] if not arg["indexed"]]
+
+    if event_name == "Transfer" and [arg_type for _, arg_type in indexed_inputs] == ["address", "address"] and data_types == ["uint256"]:
+        def decode_args(log):
+            topics = log["topics"]
+            return {
+                indexed_inputs[0][0]: _checksum_address("0x" + topics[1][-40:]),
+                indexed_inputs[1][0]: _checksum_address("0x" + topics[2][-40:]),
+                data_names[0]: int(log["data"], 16),
+            }
+    else:
+        def decode_args(log):
+            args = {name: codec.decode([arg_type], to_bytes(hexstr=topic))[0]
+                    for (name, arg_type), topic in zip(indexed_inputs, log["topics"][1:])}
+            args.update(zip(data_names, codec.decode(data_types, to_bytes(hexstr=log["data"]))))
+            return args
+
+    def decode(log):
+        # Block number, log and transaction index are null for pending blocks
+        block_number = log["blockNumber"]
+        log_index = log["logIndex"]
+        transaction_index = log["transactionIndex"]
+        return {
+            "event": event_name,
+            "args": decode_args(log),
+            "address": log["address"],
+            "blockHash": log["blockHash"],
+            "blockNumber": None if block_number is None else int(block_number, 16),
+            "transactionHash": log["transactionHash"],
+            "transactionIndex": None if transaction_index is None else int(transaction_index, 16),
+            "logIndex": None if log_index is None else int(log_index, 16),
+        }
+
+    return decode
+
 async def _fetch_events_for_all_contracts(
         web3,
-        event,
-        argument_filters: dict,
+        decoders: Dict[str, Callable[[dict], dict]],
+        event_filter_params: dict,
         from_block: int,
         to_block: int) -> Iterable:
     """Get events using eth_get_logs API.
@@ -336,110 +633,84 @@ async def _fetch_events_for_all_contracts(
 
     This is a stateless method, as opposed to createFilter.
     It can be safely called against nodes which do not provide `eth_newFilter` API, like Infura.
+
+    :param decoders: Log decoders of the events keyed by their hex encoded signature
+    :param event_filter_params: `eth_get_logs` parameters without the block range
     """
 
     if from_block is None:
         raise TypeError(
             "Missing mandatory keyword argument to get_logs: fromBlock")
 
-    # Currently no way to poke this using a public Web3.py API.
-    # This will return raw underlying ABI JSON object for the event
-    abi = event._get_event_abi()
-
-    # Depending on the Solidity version used to compile
-    # the contract that uses the ABI,
-    # it might have Solidity ABI encoding v1 or v2.
-    # We just assume the default that you set on Web3 object here.
-    # More information here https://eth-abi.readthedocs.io/en/latest/index.html
-    codec: ABICodec = web3.codec
-
-    # Here we need to poke a bit into Web3 internals, as this
-    # functionality is not exposed by default.
-    # Construct JSON-RPC raw filter presentation based on human readable Python descriptions
-    # Namely, convert event names to their keccak signatures
-    # More information here:
-    # https://github.com/ethereum/web3.py/blob/e176ce0793dafdd0573acc8d4b76425b6eb604ca/web3/_utils/filters.py#L71
-    data_filter_set, event_filter_params = construct_event_filter_params(
-        abi,
-        codec,
-        address=argument_filters.get("address"),
-        argument_filters=argument_filters,
-        fromBlock=from_block,
-        toBlock=to_block
-    )
+    event_filter_params = dict(event_filter_params, fromBlock=hex(from_block), toBlock=hex(to_block))
 
     logger.info(f"Querying eth_get_logs with the following parameters: {event_filter_params}")
 
     # Call JSON-RPC API on your Ethereum node.
-    # get_logs() returns raw AttributedDict entries
-    logs = await web3.eth.get_logs(event_filter_params)
-
-    # Convert raw binary data to Python proxy objects as described by ABI
-    all_events = []
-    for log in logs:
-        # Convert raw JSON-RPC log result to human readable event by using ABI data
-        # More information how processLog works here
-        # https://github.com/ethereum/web3.py/blob/fbaf1ad11b0c7fac09ba34baff2c256cffe0a148/web3/_utils/events.py#L200
-        evt = get_event_data(codec, abi, log)
-        # Note: This was originally yield,
-        # but deferring the timeout exception caused the throttle logic not to work
-        all_events.append(evt)
-    return all_events
-
-count_of_iteration = 0
-
-async def get_contract_creation_block(web3, contract_address, blocknumber_from, blocknumber_to, count=0):
-        logger.info("try to finde creation block ...")
-        middle_block = (blocknumber_from + blocknumber_to) // 2
-        n_minus_one_is_contract = str((await web3.eth.get_code(contract_address, middle_block-1)).hex()) != str(HexBytes('0x').hex())
-        n_is_contract = str((await web3.eth.get_code(contract_address, middle_block)).hex()) != str(HexBytes('0x').hex())
-
-        if n_is_contract and not n_minus_one_is_contract:
-            logger.info(count)
-            return middle_block
-        elif n_is_contract and n_minus_one_is_contract:       
-            return await get_contract_creation_block(web3, contract_address, blocknumber_from, middle_block, count+1)
+    # We get raw logs with hex encoded fields
+    response = await _make_raw_request(web3, {"jsonrpc": "2.0", "id": 1, "method": "eth_getLogs", "params": [event_filter_params]})
+    if "error" in response:
+        raise ValueError(response["error"])
+
+    # Convert raw JSON-RPC logs to human readable events by using ABI data.
+    # The first topic is the event signature, it tells which decoder to use.
+    # Note: This was originally yield,
+    # but deferring the timeout exception caused the throttle logic not to work
+    return [decoders[log["topics"][0]](log) for log in response["result"]]
+
+async def get_contract_creation_block(web3, contract_address, blocknumber_from, blocknumber_to):
+    """Binary search the first block where the contract has code.
+
+    Sequential binary search is a long chain of round trips, so we first probe
+    blocks `to, to/2, to/4, ...` concurrently to bracket the creation block,
+    and only then binary search inside that much smaller window.
+
+    :param blocknumber_to: Block where the contract is known to exist
+    """
+    logger.info("try to finde creation block ...")
+    # Remember probed blocks, so no block is asked twice
+    code_at: Dict[int, bool] = {}
+
+    probes = [blocknumber_to >> i for i in range(blocknumber_to.bit_length())
+              if blocknumber_to >> i >= blocknumber_from]
+    codes = await asyncio.gather(*[web3.eth.get_code(contract_address, block_number) for block_number in probes])
+    for block_number, code in zip(probes, codes):
+        code_at[block_number] = len(code) > 0
+
+    # Probes go from the newest block down, stop at the first one without code
+    for block_number in probes:
+        if code_at[block_number]:
+            blocknumber_to = block_number
         else:
-            return await get_contract_creation_block(web3, contract_address, middle_block, blocknumber_to, count+1)
+            blocknumber_from = block_number + 1
+            break
 
-async def filter(mongo, web3, contract_address):
-    # import sys
-    import json
+    async def is_contract(block_number):
+        if block_number not in code_at:
+            code_at[block_number] = len(await web3.eth.get_code(contract_address, block_number)) > 0
+        return code_at[block_number]
 
-    TARGET_TOKEN_ADDRESS = contract_address
+    while blocknumber_from < blocknumber_to:
+        middle_block = (blocknumber_from + blocknumber_to) // 2
+        if await is_contract(middle_block):
+            blocknumber_to = middle_block
+        else:
+            blocknumber_from = middle_block + 1
+    return blocknumber_from
 
-    # Reduced ERC-20 ABI, only Transfer event
-    ABI = """[
-        {
-            "anonymous": false,
-            "inputs": [
-                {
-                    "indexed": true,
-                    "name": "from",
-                    "type": "address"
-                },
-                {
-                    "indexed": true,
-                    "name": "to",
-                    "type": "address"
-                },
-                {
-                    "indexed": false,
-                    "name": "value",
-                    "type": "uint256"
-                }
-            ],
-            "name": "Transfer",
-            "type": "event"
-        }
-    ]
+async def filter(mongo, web3, contract_address, background_tasks=None):
+    """Scan Transfer events of the token and store them in `mongo`.
+
+    :param background_tasks: FastAPI `BackgroundTasks`, if given the remaining
+        database writes finish after the response is sent
     """
+    TARGET_TOKEN_ADDRESS = contract_address
 
     class JSONifiedState(EventScannerState):
         """Store the state of scanned blocks and all events.
 
-        All state is an in-memory dict.
-        Simple load/store massive JSON on start up.
+        Only the last scanned block is kept in memory,
+        events are buffered and written to MongoDB in batches.
         """
 
         def __init__(self):
@@ -447,22 +718,27 @@ async def filter(mongo, web3, contract_address):
             self.fname = "test-state.json"
             # How many second ago we saved the JSON file
             self.last_save = 0
+            # Transfers not yet handed to MongoDB
+            self._pending = []
+            # Inserts running in the background
+            self._inserts = []
+            # Scanned block waiting for its transfers to be written
+            self._scanned_block = None
 
         def reset(self):
             """Create initial state of nothing scanned."""
             self.state = {
                 "last_scanned_block": 0,
-                "blocks": {},
             }
 
         async def restore(self, contract_address):
             """Restore the last scan state from a file."""
+            self.contract_address = contract_address
             try:
                 logger.info("search the block of contract deploy")
                 last_scanned_block = await mongo.lastScannedBlock.find_one({"contract_address": contract_address})
                 self.state = {
                 "last_scanned_block": last_scanned_block['block_number'],
-                "blocks": {},
             }
                 logger.info(
                     f"Restored the state, previously {self.state['last_scanned_block']} blocks have been scanned")
@@ -478,47 +754,60 @@ async def filter(mongo, web3, contract_address):
             return self.state["last_scanned_block"]
 
         async def end_chunk(self, block_number):
-            """Save at the end of each block, so we can resume in the case of a crash or CTRL+C"""
+            """Remember the scanned block, it is saved by `flush` once its transfers are written"""
+            self._scanned_block = block_number
 
-            await mongo.lastScannedBlock.find_one_and_update({"contract_address": self.filters["address"]}, {"block_number": block_number })
+        async def _save_scanned_block(self):
+            """Save the scanned block, so we can resume in the case of a crash or CTRL+C"""
+            if self._scanned_block is not None:
+                await mongo.lastScannedBlock.find_one_and_update({"contract_address": self.contract_address}, {"$set": {"block_number": self._scanned_block}})
 
-        def process_event(self, block_when: datetime.datetime, event: AttributeDict) -> str:
+        async def _insert(self, transfers):
+            try:
+                # Unordered, so MongoDB can apply the inserts in parallel
+                await mongo.transferEvents.insert_many(transfers, ordered=False, bypass_document_validation=True)
+            except BulkWriteError as e:
+                # Rescanned blocks hit the unique (tx_hash, log_index) index, anything else is a real error
+                if any(error["code"] != DUPLICATE_KEY_ERROR for error in e.details["writeErrors"]):
+                    raise
+
+        def _flush_pending(self):
+            """Start writing the buffered transfers in the background."""
+            if self._pending:
+                self._inserts.append(asyncio.create_task(self._insert(self._pending)))
+                self._pending = []
+
+        async def flush(self):
+            """Write all buffered transfers, then save the scanned block.
+
+            If any insert fails the progress is not saved, so the blocks are scanned again next time
+            """
+            self._flush_pending()
+            await asyncio.gather(*self._inserts)
+            self._inserts = []
+            await self._save_scanned_block()
+
+        def process_event(self, block_when: int, event: dict) -> dict:
             """Record a ERC-20 transfer in our database."""
             # Events are keyed by their transaction hash and log index
             # One transaction may contain multiple events
             # and each one of those gets their own log index
-
-            # event_name = event.event # "Transfer"
-            log_index = event.logIndex  # Log index within the block
-            # transaction_index = event.transactionIndex  # Transaction index within the block
-            txhash = event.transactionHash.hex()  # Transaction hash
-            block_number = event.blockNumber
-
-            # Convert ERC-20 Transfer event to our internal format
             args = event["args"]
             transfer = {
-                "from": args["from"],
-                "to": args.to,
-                "value": args.value,
-                "timestamp": block_when.isoformat(),
+                "block": event["blockNumber"],
+                "tx_hash": event["transactionHash"],
+                "address_from": args["from"],
+                "address_to": args["to"],
+                # uint256 does not fit MongoDB integers
+                "value": str(args["value"]),
+                "log_index": event["logIndex"],
+                "timestamp": block_when,
             }
 
-            # Create empty dict as the block that contains all transactions by txhash
-            if block_number not in self.state["blocks"]:
-                self.state["blocks"][block_number] = {}
-
-            block = self.state["blocks"][block_number]
-            if txhash not in block:
-                # We have not yet recorded any transfers in this transaction
-                # (One transaction may contain multiple events if executed by a smart contract).
-                # Create a tx entry that contains all events by a log index
-                self.state["blocks"][block_number][txhash] = {}
-
-            # Record ERC-20 transfer in our database
-            self.state["blocks"][block_number][txhash][log_index] = transfer
-
-            # Return a pointer that allows us to look up this event later if needed
-            return f"{block_number}-{txhash}-{log_index}"
+            self._pending.append(transfer)
+            if len(self._pending) >= INSERT_BATCH_SIZE:
+                self._flush_pending()
+            return transfer
 
     async def run():
 
@@ -527,8 +816,7 @@ async def filter(mongo, web3, contract_address):
         logging.basicConfig(level=logging.INFO)
 
         # Prepare stub ERC-20 contract object
-        abi = json.loads(ABI)
-        ERC20 = web3.eth.contract(abi=abi)
+        ERC20 = web3.eth.contract(abi=ERC20_TRANSFER_ABI)
 
         # Restore/create our persistent state
         state = JSONifiedState()
@@ -580,35 +868,25 @@ async def filter(mongo, web3, contract_address):
 
         start = time.time()
 
-        await scanner.scan(cutoff_block, cutoff_block + MAX_CHUNK_SIZE*5+1)
-
-        result = scanner.all_processed
+        # Never save progress past the chain head, blocks mined later would be skipped
+        scan_end_block = min(end_block, cutoff_block + MAX_CHUNK_SIZE*5+1)
+        if cutoff_block <= scan_end_block:
+            await scanner.scan(cutoff_block, scan_end_block)
+            result = scanner.all_processed
+        else:
+            # Already caught up with the chain
+            result = []
 
+        if background_tasks is not None:
+            # Do not keep the client waiting for MongoDB
+            background_tasks.add_task(state.flush)
+        else:
+            await state.flush()
         state.save()
         
         duration = time.time() - start
         logger.info(f"Scanned total {len(result)} Transfer events, in {duration} seconds")
         
-        json_file_after = { "events" : []}
-        data = state.state
-
-        for block_number in data["blocks"]:
-            for tx_hash in data["blocks"][block_number]:
-                    for event_number in data["blocks"][block_number][tx_hash]:
-                        addr_from = data["blocks"][block_number][tx_hash][event_number]["from"]
-                        addr_to = data["blocks"][block_number][tx_hash][event_number]["to"]
-                        value = data["blocks"][block_number][tx_hash][event_number]["value"]
-                        json_file_after["events"].append(
-                            {'block': block_number, 
-                                'tx_hash': str(tx_hash),
-                                'address_from': str(addr_from),
-                                'address_to': str(addr_to),
-                                'value': str(value)
-                                })
-                        
-        if json_file_after['events'] != []:
-            await mongo.transferEvents.insert_many(json_file_after['events'])
-
         return True
     
     success = await run()
@@ -1,30 +1,33 @@
 # import datetime
 import uvicorn
-import json
+import mmap
+import orjson
 from pydantic import BaseModel, ValidationError
-from typing import List, Optional
+from typing import List, Optional, TypedDict
 
 import asyncio
 import motor.motor_asyncio
 
 from fastapi.logger import logger
-from fastapi import FastAPI, Request, status
-from fastapi.responses import JSONResponse
-from fastapi.encoders import jsonable_encoder
+from fastapi import BackgroundTasks, FastAPI, Request, status
+from fastapi.responses import ORJSONResponse
 import logging
 
 from envparse import Env
 
-from web3 import AsyncWeb3, AsyncHTTPProvider
+from web3 import AsyncWeb3
+
+from provider import AsyncHTTPXProvider
 
 import os
+from functools import lru_cache
 
 from event_filter import filter
 
 gunicorn_logger = logging.getLogger('gunicorn.error')
 logger.handlers = gunicorn_logger.handlers
     
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
 DEFAULT_RPC = "https://mainnet.infura.io/v3/1df40ac1020e4a9083b81e1e7c6892be"
 DEFAULT_MONGO = "mongodb://localhost:27017/local"
@@ -34,9 +37,11 @@ MONGODB_URL = env.str("MONGODB_URL", default=DEFAULT_MONGO)
 RPC = env.str("RPC", default=DEFAULT_RPC)
 
  
-# Load ERC20 token ABI from file
-abi_file = open('abi.json')
-abi = json.load(abi_file)
+# Load ERC20 token ABI from file, parsed once for the process
+# Mapped instead of read, so orjson parses the page cache directly
+with open('abi.json', 'rb') as abi_file, mmap.mmap(abi_file.fileno(), 0, access=mmap.ACCESS_READ) as abi_map:
+    with memoryview(abi_map) as abi_view:
+        abi = orjson.loads(abi_view)
 
 
 class Balance(BaseModel):
@@ -50,11 +55,19 @@ class Wallet(BaseModel):
     actual_token_balance: str
     token_history: Optional[List[Balance]] = []
 
+# Typing only, the hot balance endpoint skips response model validation
+WalletResp = TypedDict("WalletResp", {
+    "Success": bool,
+    "Wallet": str,
+    "Eth Balance in Wai": str,
+    "Token Balance in Wai": str,
+})
+
 @app.exception_handler(ValidationError)
 async def validation_exception_handler(request: Request, exc: ValidationError):
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
-        content=jsonable_encoder({"detail": exc.errors()}),
+        content={"detail": exc.errors()},
     )
     
 @app.get("/")
@@ -63,32 +76,34 @@ async def mainpage() -> str:
 
 @app.get("/pingRPC")
 async def ping() -> dict:
-    web3 = instanciate_w3(RPC)
-    return {"Success": {await web3.is_connected()}}
+    return {"Success": {await WEB3.is_connected()}}
    
 # user_address = "0x7a16ff8270133f063aab6c9977183d9e72835428" 
 # contract_address = "0xD533a949740bb3306d119CC777fa900bA034cd52" 
 
-@app.get("/address/{user_address, contract_address}")
-async def balance_of_token(request: Request, user_address: str, contract_address: str,):
-    web3 = instanciate_w3(RPC)
-    eth_Balance = await web3.eth.get_balance(to_checksum(user_address))
-    contract = web3.eth.contract(to_checksum(contract_address), abi=abi)
-    token_balance = await contract.functions.balanceOf(to_checksum(user_address)).call()
+# No runtime effect on the pinned FastAPI. From 0.89 on, it stops the return
+# annotation from becoming a response model validated on every reply
+@app.get("/address/{user_address, contract_address}", response_model=None)
+async def balance_of_token(request: Request, user_address: str, contract_address: str,) -> WalletResp:
+    user_cs = to_checksum(user_address)
+    contract_cs = to_checksum(contract_address)
+    contract = get_contract(contract_cs)
+    # Both calls go to the node in one JSON-RPC batch
+    eth_result, token_result = await WEB3.provider.make_batch_request([
+        ("eth_getBalance", [user_cs, "latest"]),
+        ("eth_call", [{"to": contract.address, "data": contract.encodeABI(fn_name="balanceOf", args=[user_cs])}, "latest"]),
+    ])
+    eth_Balance = AsyncWeb3.to_int(hexstr=eth_result)
+    token_balance = WEB3.codec.decode(["uint256"], AsyncWeb3.to_bytes(hexstr=token_result))[0]
     return {"Success": True,
             "Wallet": str(user_address),
             "Eth Balance in Wai": str(eth_Balance),
             "Token Balance in Wai": str(token_balance) }
 
 @app.post("/address/{contract_address}")
-async def contract_token_events(request: Request, contract_address: str,):
+async def contract_token_events(request: Request, contract_address: str, background_tasks: BackgroundTasks):
     # logger.setLevel(logging.DEBUG)
-    web3 = instanciate_w3(RPC)
-    client = motor.motor_asyncio.AsyncIOMotorClient(DEFAULT_MONGO, serverSelectionTimeoutMS=5000)
-    
-    database = client.testdb
-    
-    filter_success = await filter(database, web3, contract_address)    
+    filter_success = await filter(DATABASE, WEB3, contract_address, background_tasks)    
     
     return {"Success": filter_success,
             "Contract": str(contract_address)}
@@ -104,11 +119,57 @@ async def contract_token_events(request: Request, contract_address: str,):
 #     return res
 
 def instanciate_w3(url) -> AsyncWeb3:
-    w3_instance = AsyncWeb3(AsyncHTTPProvider(url))
+    w3_instance = AsyncWeb3(AsyncHTTPXProvider(url))
     return w3_instance
+@lru_cache(maxsize=4096)
+def get_contract(checksum_address):
+    contract = WEB3.eth.contract(checksum_address, abi=abi)
+    return contract
+# Same wallets and tokens come again and again, skip Keccak for them
+@lru_cache(maxsize=100_000)
 def to_checksum(address):
-    checksum = AsyncWeb3.to_checksum_address(address.lower())
+    checksum = AsyncWeb3.to_checksum_address(address)
     return checksum
 
+# One client for all requests, so connections to the node are reused.
+# Same for MongoDB, every client has its own connection pool
+WEB3: AsyncWeb3 = None
+MONGO: motor.motor_asyncio.AsyncIOMotorClient = None
+DATABASE = None
+COLL = None
+
+@app.on_event("startup")
+async def create_clients():
+    # Created in every worker on its own event loop, so no pool is shared between processes
+    global WEB3, MONGO, DATABASE, COLL
+    WEB3 = instanciate_w3(RPC)
+    MONGO = motor.motor_asyncio.AsyncIOMotorClient(MONGODB_URL, maxPoolSize=100, serverSelectionTimeoutMS=5000)
+    DATABASE = MONGO.testdb
+    COLL = DATABASE.transferEvents
+    app.state.web3 = WEB3
+    app.state.mongo_client = MONGO
+    # Not awaited, the balance endpoint does not need MongoDB to serve requests
+    app.state.create_indexes = asyncio.create_task(create_indexes(COLL))
+
+async def create_indexes(coll):
+    """Index transfers, a failure is logged and does not stop the app."""
+    try:
+        # Lookups by block and by wallet would scan the whole collection otherwise.
+        # One transaction can emit several transfers, so a transfer is unique by its log index in the transaction.
+        # Older documents have no log index, they are left out of the unique index
+        await coll.create_index([("block", 1)])
+        await coll.create_index([("tx_hash", 1), ("log_index", 1)], unique=True,
+                                partialFilterExpression={"log_index": {"$exists": True}})
+        await coll.create_index([("address_from", 1)])
+        await coll.create_index([("address_to", 1)])
+    except Exception:
+        logger.exception("Could not create transferEvents indexes")
+
+@app.on_event("shutdown")
+async def close_clients():
+    await WEB3.provider.disconnect()
+    MONGO.close()
+
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    uvicorn.run("main:app", host="0.0.0.0", port=8000,
+                loop="uvloop", http="httptools", workers=os.cpu_count(), proxy_headers=True)
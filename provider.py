@@ -0,0 +1,93 @@
+from typing import Any, List, Optional, Tuple
+
+import httpx
+import orjson
+
+from web3 import AsyncHTTPProvider
+from web3.types import RPCEndpoint, RPCResponse
+
+
+class AsyncHTTPXProvider(AsyncHTTPProvider):
+    """Async JSON-RPC provider that keeps one pooled HTTP/2 client for all requests.
+
+    The default provider talks HTTP/1.1 over aiohttp with a small connection pool,
+    which caps how many concurrent `eth_get_logs` calls we can have in flight.
+    """
+
+    def __init__(self, endpoint_uri: Optional[str] = None, request_kwargs: Optional[Any] = None,
+                 client: Optional[httpx.AsyncClient] = None):
+        """
+        :param request_kwargs: The same as for `AsyncHTTPProvider`, headers, timeout and basic auth are used
+        :param client: HTTP client to use, a HTTP/2 client with up to 64 connections by default.
+            Idle connections are kept alive for 75 seconds, so TCP and TLS handshakes are rare
+        """
+        super().__init__(endpoint_uri, request_kwargs)
+        self.client = client or httpx.AsyncClient(
+            http2=True,
+            timeout=30.0,
+            limits=httpx.Limits(max_keepalive_connections=32, max_connections=64, keepalive_expiry=75))
+
+        # `request_kwargs` are written for aiohttp, keep the ones httpx understands as well
+        request_kwargs = dict(self.get_request_kwargs())
+        self._httpx_kwargs = {"headers": request_kwargs["headers"]}
+        if request_kwargs.get("timeout") is not None:
+            # aiohttp.ClientTimeout or plain seconds
+            timeout = request_kwargs["timeout"]
+            self._httpx_kwargs["timeout"] = getattr(timeout, "total", timeout)
+        if request_kwargs.get("auth") is not None:
+            # aiohttp.BasicAuth is a (login, password, encoding) tuple
+            self._httpx_kwargs["auth"] = tuple(request_kwargs["auth"][:2])
+
+    async def disconnect(self):
+        """Close all pooled connections."""
+        await self.client.aclose()
+
+    async def make_raw_request(self, data: bytes) -> bytes:
+        """Post an already encoded JSON-RPC payload and return the raw response body."""
+        try:
+            response = await self.client.post(self.endpoint_uri, content=data, **self._httpx_kwargs)
+        except httpx.TransportError as e:
+            # httpx errors are not OSError like the aiohttp ones, `is_connected` only catches OSError
+            raise ConnectionError(f"Could not reach {self.endpoint_uri}: {e}") from e
+        response.raise_for_status()
+        return response.content
+
+    async def make_request(self, method: RPCEndpoint, params: Any) -> RPCResponse:
+        self.logger.debug(f"Making request HTTP. URI: {self.endpoint_uri}, Method: {method}")
+        request_data = self.encode_rpc_request(method, params)
+        raw_response = await self.make_raw_request(request_data)
+        response = self.decode_rpc_response(raw_response)
+        self.logger.debug(f"Getting response HTTP. URI: {self.endpoint_uri}, Method: {method}, Response: {response}")
+        return response
+
+    async def make_batch_request(self, requests: List[Tuple[RPCEndpoint, Any]]) -> List[Any]:
+        """Send several calls to the node as one JSON-RPC batch, in a single HTTP round trip.
+
+        :param requests: List of (method, params)
+        :return: Raw results in the order of `requests`
+        """
+        return decode_batch_response(await self.make_raw_request(encode_batch_request(requests)), len(requests))
+
+
+def encode_batch_request(requests: List[Tuple[RPCEndpoint, Any]]) -> bytes:
+    """Encode (method, params) pairs as a JSON-RPC batch, ids are the positions in `requests`."""
+    return orjson.dumps([{"jsonrpc": "2.0", "id": request_id, "method": method, "params": params}
+                         for request_id, (method, params) in enumerate(requests)])
+
+
+def decode_batch_response(raw_response: bytes, size: int) -> List[Any]:
+    """Get results of a batch encoded by `encode_batch_request`, in the order of its requests.
+
+    :raise ValueError: If the batch or any single call in it failed
+    """
+    responses = orjson.loads(raw_response)
+    if not isinstance(responses, list):
+        # Provider refused the whole batch
+        raise ValueError(responses.get("error"))
+
+    results = {}
+    for response in responses:
+        if "error" in response:
+            raise ValueError(response["error"])
+        results[response["id"]] = response["result"]
+    return [results[request_id] for request_id in range(size)]
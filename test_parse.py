@@ -1,61 +1,66 @@
-import json
-
-str_json = """{
-  "last_scanned_block": 17987494,
-  "blocks": {
-    "17986230": {
-      "0xba963f6a4e9619fac1faf66009e3ad7b5d3237bfff7a8b82da2762a99a7bcc56": {
-        "344": {
-          "from": "0x7B95Ec873268a6BFC6427e7a28e396Db9D0ebc65",
-          "to": "0x94E61aeA6aD9F699c9C7572B1a2E62661FeD98B6",
-          "value": 27796315810770500972682,
-          "timestamp": "2023-08-24T18:04:35"
-        }
-      }
-    },
-    "17986256": {
-      "0x923459c08a274286c77402851ba4a332deaf913e503082d50d29d2a49b694117": {
-        "213": {
-          "from": "0x94E61aeA6aD9F699c9C7572B1a2E62661FeD98B6",
-          "to": "0x38F5E5b4DA37531a6e85161e337e0238bB27aa90",
-          "value": 42287324927037809009,
-          "timestamp": "2023-08-24T18:09:47"
-        },
-        "214": {
-          "from": "0x94E61aeA6aD9F699c9C7572B1a2E62661FeD98B6",
-          "to": "0x22F9dCF4647084d6C31b2765F6910cd85C178C18",
-          "value": 27754028485843463163673,
-          "timestamp": "2023-08-24T18:09:47"
-        },
-        "215": {
-          "from": "0x22F9dCF4647084d6C31b2765F6910cd85C178C18",
-          "to": "0x4eBdF703948ddCEA3B11f675B4D1Fba9d2414A14",
-          "value": 27754028485843463163673,
-          "timestamp": "2023-08-24T18:09:47"
-        }
-      }
-    }
-  }
-}"""
-
-data = json.loads(str_json)
-start_balance = 0
-
-json_file_after = { "events" : []}
-
-for block_number in data["blocks"]:
-        for tx_hash in data["blocks"][block_number]:
-                for event_number in data["blocks"][block_number][tx_hash]:
-                    addr_from = data["blocks"][block_number][tx_hash][event_number]["from"]
-                    addr_to = data["blocks"][block_number][tx_hash][event_number]["to"]
-                    value = data["blocks"][block_number][tx_hash][event_number]["value"]
-                    json_file_after["events"].append(
-                        {"block": block_number, 
-                            "tx_hash": tx_hash,
-                            "address_from": addr_from,
-                            "address_to": addr_to,
-                            "value": value
-                            })
+import ijson
+import numpy as np
+
+# Scan state dump, the same layout as test-state.json
+DUMP_FILE = "json1.json"
+
+# Wallet whose token balance we count from the transfers
+ADDR_TARGET = "0x94E61aeA6aD9F699c9C7572B1a2E62661FeD98B6"
+# Addresses are compared as raw 20 bytes, so checksum casing never matters
+TARGET = bytes.fromhex(ADDR_TARGET[2:])
+
+# Stream the dump block by block, so the raw JSON tree is never held in memory at once.
+# The compact events are still all collected, memory grows with their number.
+# ijson keeps wei values as exact ints (orjson would turn values over 64 bits into floats)
+with open(DUMP_FILE, "rb") as dump:
+    json_file_after = { "events" : [
+        {"block": block_number,
+            "tx_hash": tx_hash,
+            "address_from": bytes.fromhex(event["from"][2:]),
+            "address_to": bytes.fromhex(event["to"][2:]),
+            # Dumps taken from MongoDB keep wei values as strings, parse them once here
+            "value": int(event["value"])
+            }
+        for block_number, block in ijson.kvitems(dump, "blocks")
+        for tx_hash, tx in block.items()
+        for event in tx.values()]}
+
+
+# uint256 values are split into 32-bit limbs held in uint64 columns,
+# so a column sum only overflows after 2**32 events
+VALUE_LIMBS = 8
+LIMB_BITS = 32
+
+
+def to_columns(events):
+    """Lay the transfers out as columns: sender and recipient as (N, 20) uint8, values as (N, 8) uint64 limbs."""
+    address_from = np.frombuffer(b"".join(event["address_from"] for event in events), dtype=np.uint8).reshape(-1, 20)
+    address_to = np.frombuffer(b"".join(event["address_to"] for event in events), dtype=np.uint8).reshape(-1, 20)
+    values = np.frombuffer(b"".join(event["value"].to_bytes(VALUE_LIMBS * LIMB_BITS // 8, "little") for event in events),
+                           dtype="<u4").reshape(-1, VALUE_LIMBS).astype(np.uint64)
+    return address_from, address_to, values
+
+
+def sum_limbs(values):
+    """Exact sum of uint256 values given as limb rows."""
+    return sum(int(limb_sum) << (LIMB_BITS * i) for i, limb_sum in enumerate(values.sum(axis=0, dtype=np.uint64)))
+
+
+def net_balance(address_from, address_to, values, target):
+    """Sum of incoming minus outgoing transfer values of `target`.
+
+    Address matching and the limb sums run as vectorized numpy loops, only the
+    final eight limbs are recombined as Python ints.
+    A transfer to self adds and subtracts the value, leaving the balance unchanged
+    """
+    target = np.frombuffer(target, dtype=np.uint8)
+    incoming = (address_to == target).all(axis=1)
+    outgoing = (address_from == target).all(axis=1)
+    return sum_limbs(values[incoming]) - sum_limbs(values[outgoing])
+
+
+balance = net_balance(*to_columns(json_file_after["events"]), TARGET)
 
 # print((json_file_after))
 print(json_file_after)
+print(balance)